@@ -2,9 +2,11 @@
 """n-gram generator on word, char and charset basis
 
 Usage:
-  gramify.py word <input_file> (<output_file>|--stdout) [--min-length=<int>] [--max-length=<int>] [--ngram-more]
-  gramify.py character <input_file> (<output_file>|--stdout) [--min-length=<int>] [--max-length=<int>] [--rolling]
-  gramify.py charset <input_file> <output_file> [--min-length=<int>] [--max-length=<int>] [--mixed] [--filter=<str>] [--filter-combo-length=<str>] [--cgram-rulify-beta]
+  gramify.py word <input_file> (<output_file>|--stdout) [--min-length=<int>] [--max-length=<int>] [--ngram-more] [--pipeline] [--max-line-length=<int>] [--long-line=<str>] [--shard=<i/N>] [--partial] [--workers=<int>] [--min-count=<int>]
+  gramify.py character <input_file> (<output_file>|--stdout) [--min-length=<int>] [--max-length=<int>] [--rolling] [--pipeline] [--max-line-length=<int>] [--long-line=<str>] [--shard=<i/N>] [--partial] [--workers=<int>] [--min-count=<int>]
+  gramify.py charset <input_file> <output_file> [--min-length=<int>] [--max-length=<int>] [--mixed] [--filter=<str>] [--filter-combo-length=<str>] [--cgram-rulify-beta] [--stats] [--pipeline] [--max-line-length=<int>] [--long-line=<str>] [--shard=<i/N>] [--partial] [--workers=<int>] [--min-count=<int>]
+  gramify.py reduce <partial_file>... [--min-count=<int>]
+  gramify.py batch <manifest_file>
   gramify.py (-h | --help)
   gramify.py --version
 
@@ -20,6 +22,14 @@ Options:
   --filter-combo-length-beta=<int>   Create automatic filter combinations of start,mid,end (startmid,startmidmidendend) based on length [BETA]
   --cgram-rulify-beta           Convert cgram output into hashcat-rules [BETA]
   --ngram-more                  Add extra candidates by removing casing and special characters
+  --stats                       Write hashcat masks (.hcmask) and PACK-style length, structure and mask statistics
+  --pipeline                    Overlap reading, processing and writing using background I/O threads
+  --max-line-length=<int>       Maximum input line length before --long-line applies. (Default: 256 for character without --rolling, otherwise no limit)
+  --long-line=<str>             Handle lines over --max-line-length using skip, truncate, window or separate-file. (Default: skip)
+  --shard=<i/N>                 Only process the i-th of N equal byte ranges of the input, counting from 0. (ex: --shard=0/4)
+  --partial                     Write sorted partial count files (<output>.part<i>of<N>) to be merged by reduce
+  --workers=<int>               Split the input over <int> local worker processes and reduce their partial outputs
+  --min-count=<int>             Minimum total count of a gram to be kept by reduce or --workers. (Default: 1)
 
 Gram-types:
   K-Gram (Character):           Letter based https://nlp.stanford.edu/IR-book/html/htmledition/k-gram-indexes-for-wildcard-queries-1.html
@@ -35,17 +45,28 @@ Filter:
   using --filter 'midend' will output 1 file containing the middle and end elements, but not the first which is perfect for -a7 hybrid attacks.
   You can make any combination yourself. "startmidstartmidendmidstart" for example.
   Recommended filters to play with are listed above
+
+Batch:
+  The manifest file holds one gramify command per line without the leading gramify.py, for example:
+    charset alice.txt alice.txt --min-length=1 --filter=start,end
+    character bob.txt bob.txt --rolling
+  All commands run in one process, which avoids the startup cost when processing many small wordlists.
+  Empty lines and lines starting with # are ignored.
 """
 import re
 import os
 import sys
-import binascii
-from itertools import permutations
-from tqdm import tqdm
+import heapq
+from array import array
+from collections import Counter
+from itertools import islice
 from docopt import docopt
+# tqdm, binascii, queue, threading, multiprocessing and shlex are imported where they are needed to keep startup fast
 
-sys.setrecursionlimit(5000)
 output_file_names = []
+line_length_reports = []  # (max line length, long line file, counts) of every LineLengthPolicy, summed by run_workers
+GRAM_STORE_SPILL_BYTES = 256 * 1024 * 1024  # per --partial output
+STATS_PARTIAL_PREFIX = "stats_"  # gram outputs always start with c_, k_ or n_, so reduce can tell the statistics apart
 
 
 def output_filter_writer(output_filter, output_filter_file_handler, matches):
@@ -283,24 +304,27 @@ def ngramify(docopt_args):
     output_file = docopt_args.get('<output_file>')
     ngram_more = bool(docopt_args['--ngram-more'])
     use_stdout = bool(docopt_args['--stdout'])
-    if ARGS.get('--min-length') is None:
+    pipeline = IOPipeline() if docopt_args.get('--pipeline') else None
+    suffix = partial_suffix(docopt_args)
+    if docopt_args.get('--min-length') is None:
         min_length = 1
     else:
         min_length = int(docopt_args.get('--min-length'))
 
-    if ARGS.get('--max-length') is None:
+    if docopt_args.get('--max-length') is None:
         max_length = 10
     else:
         max_length = int(docopt_args.get('--max-length'))
 
-    input_file_handler = open(input_file, "r", encoding="utf-8", errors="ignore")
+    input_file_handler = open_input(input_file, docopt_args.get('--shard'))
     if not use_stdout:
-        output_file_handler = open("n_" + output_file, "a+", encoding="utf-8", errors="ignore")
+        output_file_handler = open_output("n_" + output_file, pipeline, suffix)
         output_file_names.append("n_" + output_file)
         print("Writing output to: n_" + output_file)
 
     data_raw = ""
-    for line in input_file_handler:
+    line_policy = LineLengthPolicy(docopt_args, "long_" + (output_file or os.path.basename(input_file)), pipeline)
+    for line in line_policy.lines(read_lines(input_file_handler, pipeline)):
         data_raw += line.rstrip("\r\n") + " "
 
     data = re.split(" ", data_raw)
@@ -338,6 +362,8 @@ def ngramify(docopt_args):
 
     if not use_stdout: output_file_handler.close()
     input_file_handler.close()
+    line_policy.close(sys.stderr if use_stdout else sys.stdout)
+    if pipeline is not None: pipeline.close()
 
 
 def kgramify(docopt_args):
@@ -345,30 +371,37 @@ def kgramify(docopt_args):
     output_file = docopt_args['<output_file>']
     rolling = bool(docopt_args['--rolling'])
     use_stdout = bool(docopt_args['--stdout'])
+    pipeline = IOPipeline() if docopt_args.get('--pipeline') else None
+    suffix = partial_suffix(docopt_args)
 
-    if ARGS.get('--min-length') is None:
+    if docopt_args.get('--min-length') is None:
         min_length = 3
     else:
         min_length = int(docopt_args.get('--min-length'))
 
 
-    if ARGS.get('--max-length') is None:
+    if docopt_args.get('--max-length') is None:
         max_length = 32 if rolling else 8
     else:
         max_length = int(docopt_args.get('--max-length'))
 
+    line_policy = LineLengthPolicy(docopt_args, "long_" + (output_file or os.path.basename(input_file)), pipeline,
+                                   None if rolling else 256, max_length - 1)  # previous fixed limit, kept as default
+
     if rolling:
         if not use_stdout: print("Writing output to: k_rolling." + output_file)
-        in_handler = open(input_file, encoding="utf-8", errors="ignore")
+        in_handler = open_input(input_file, docopt_args.get('--shard'))
 
         if not use_stdout:
-            out_handler = open("k_rolling."+ output_file, "a+", encoding="utf-8", errors="ignore")
+            out_handler = open_output("k_rolling."+ output_file, pipeline, suffix)
             output_file_names.append("k_rolling." + output_file)
 
-        for line in in_handler:
+        for line in line_policy.lines(read_lines(in_handler, pipeline)):
             original_plaintext = line.rstrip("\r\n")
+            # Grams starting in the overlap with the next window are left to that window
+            starts = len(original_plaintext) if line_policy.window_owned is None else line_policy.window_owned
             for i in range(min_length, max_length+1):
-                for j in range(0, len(original_plaintext)+(1-i)):
+                for j in range(0, min(starts, len(original_plaintext)+(1-i))):
                     if use_stdout:
                         print(original_plaintext[j:j+i])
                     else:
@@ -378,24 +411,16 @@ def kgramify(docopt_args):
         if not use_stdout: out_handler.close()
 
     else:
-        if use_stdout:
-            print("Cannot use --stdout without --rolling")
-            sys.exit(-1)
-
         print("Writing output to: k_start." + output_file)
         print("Writing output to: k_mid." + output_file)
         print("Writing output to: k_end." + output_file)
-        with open(input_file, encoding="utf-8", errors="ignore") as fp:
-            line = True
-            start_file_handler = open("k_start."+ output_file, "a+", encoding="utf-8", errors="ignore")
-            mid_file_handler = open("k_mid."+ output_file, "a+", encoding="utf-8", errors="ignore")
-            end_file_handler = open("k_end."+ output_file, "a+", encoding="utf-8", errors="ignore")
-            while line:
-                line = fp.readline()
+        with open_input(input_file, docopt_args.get('--shard')) as fp:
+            start_file_handler = open_output("k_start."+ output_file, pipeline, suffix)
+            mid_file_handler = open_output("k_mid."+ output_file, pipeline, suffix)
+            end_file_handler = open_output("k_end."+ output_file, pipeline, suffix)
+            for line in line_policy.lines(read_lines(fp, pipeline)):
                 original_plaintext = line.rstrip("\r\n")
                 return_array = [[],[],[]]
-                if len(original_plaintext) > 256:  # prevent recursion depth
-                    continue
                 return_array = kgramify_process(return_array, original_plaintext, 0, 1, min_length, max_length)  # minus one for array offset
                 for item in return_array[0]:
                     start_file_handler.write(item + "\n")
@@ -411,53 +436,60 @@ def kgramify(docopt_args):
         output_file_names.append("k_mid." + output_file)
         output_file_names.append("k_end." + output_file)
 
+    line_policy.close(sys.stderr if use_stdout else sys.stdout)
+    if pipeline is not None: pipeline.close()
+
 
 def kgramify_process(return_array, input_word, start, end, min_length, max_length):
-    if start >= len(input_word) or len(input_word) <= min_length:
-        return return_array
-
-    elif start == 0 and end-start == max_length and end < len(input_word):
-        # First section & Mid section
-        next_start = start+1
-        next_end = end+1
-        if end-start >= min_length:
-            return_array[0].append(input_word[start:end])
-            return_array[1].append(input_word[start:end])
-    elif start > 0 and end-start == max_length and end < len(input_word):
-        # Middle section
-        next_start = start+1
-        next_end = end+1
-        if end-start >= min_length:
-            return_array[1].append(input_word[start:end])
-    elif end-start == max_length and end == len(input_word):
-        # Mid and End section
-        next_start = start+1
-        next_end = end
-        if end-start >= min_length:
-            return_array[1].append(input_word[start:end])
-            return_array[2].append(input_word[start:end])
-
-    elif start == 0 and end < len(input_word) and end-start <= max_length and end-start < len(input_word)-1:
-        # First section
-        next_start = start
-        next_end = end+1
-        if end-start >= min_length:
-            return_array[0].append(input_word[start:end])
-
-    elif start == 0 and end < len(input_word) and end-start <= max_length and end-start == len(input_word)-1:
-        # First section
-        next_start = start+1
-        next_end = end+1
-        if end-start >= min_length:
-            return_array[0].append(input_word[start:end])
-    elif start > 0 and end == len(input_word) and end-start < max_length:
-        # Last section
-        next_start = start+1
-        next_end = end
-        if end-start >= min_length:
-            return_array[2].append(input_word[start:end])
-
-    return kgramify_process(return_array, input_word, next_start, next_end, min_length, max_length)
+    # Walks the word section by section, iterative so long lines cannot hit the recursion limit
+    while True:
+        if start >= len(input_word) or len(input_word) <= min_length:
+            return return_array
+        elif start == 0 and end-start == max_length and end < len(input_word):
+            # First section & Mid section
+            next_start = start+1
+            next_end = end+1
+            if end-start >= min_length:
+                return_array[0].append(input_word[start:end])
+                return_array[1].append(input_word[start:end])
+        elif start > 0 and end-start == max_length and end < len(input_word):
+            # Middle section
+            next_start = start+1
+            next_end = end+1
+            if end-start >= min_length:
+                return_array[1].append(input_word[start:end])
+        elif end-start == max_length and end == len(input_word):
+            # Mid and End section
+            next_start = start+1
+            next_end = end
+            if end-start >= min_length:
+                return_array[1].append(input_word[start:end])
+                return_array[2].append(input_word[start:end])
+
+        elif start == 0 and end < len(input_word) and end-start <= max_length and end-start < len(input_word)-1:
+            # First section
+            next_start = start
+            next_end = end+1
+            if end-start >= min_length:
+                return_array[0].append(input_word[start:end])
+
+        elif start == 0 and end < len(input_word) and end-start <= max_length and end-start == len(input_word)-1:
+            # First section
+            next_start = start+1
+            next_end = end+1
+            if end-start >= min_length:
+                return_array[0].append(input_word[start:end])
+        elif start > 0 and end == len(input_word) and end-start < max_length:
+            # Last section
+            next_start = start+1
+            next_end = end
+            if end-start >= min_length:
+                return_array[2].append(input_word[start:end])
+        else:
+            return return_array  # no section applies, only possible with --min-length=0
+
+        start = next_start
+        end = next_end
 
 def generate_permutation_with_repeats(elements, length):
     if length == 0:
@@ -507,6 +539,568 @@ def blocks(files, size=65536):
         if not b: break
         yield b
 
+class PipelineWriter:
+    """Buffers writes for one output file and hands them to the writer thread of an IOPipeline"""
+    def __init__(self, file_handler, pipeline):
+        self.file_handler = file_handler
+        self.pipeline = pipeline
+        self.buffer_size = pipeline.buffer_size
+        self.buffer = []
+        self.buffer_length = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_length += len(data)
+        if self.buffer_length >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Surface a failed background write at the next flush instead of only when the pipeline closes
+        if self.pipeline.writer_error is not None:
+            raise self.pipeline.writer_error
+        if self.buffer_length > 0:
+            self.pipeline.write_queue.put((self.file_handler, "".join(self.buffer)))
+        self.buffer = []
+        self.buffer_length = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pipeline.write_queue.put((self.file_handler, None))
+
+class IOPipeline:
+    """Reader, processing and writer stages connected by bounded queues.
+    The reader thread prefetches large blocks of the input while the writer thread flushes
+    output buffers in the background, so the processing stage never waits on slow disks."""
+    def __init__(self, queue_size=64, block_size=1048576, buffer_size=65536):
+        import queue
+        import threading
+        self.queue_size = queue_size
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.writer_error = None
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def _writer(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None: return
+            file_handler, data = item
+            try:
+                if data is None:
+                    file_handler.close()
+                elif self.writer_error is None:  # after a failure keep draining (and closing) so producers never block
+                    file_handler.write(data)
+            except Exception as e:  # any error ends the output, but must not end this thread
+                if self.writer_error is None:
+                    self.writer_error = e
+
+    def open(self, file_name):
+        file_handler = open(file_name, "a+", encoding="utf-8", errors="ignore")
+        return PipelineWriter(file_handler, self)
+
+    def read_lines(self, file_handler):
+        import queue
+        import threading
+        read_queue = queue.Queue(maxsize=self.queue_size)
+
+        def reader():
+            try:
+                for block in blocks(file_handler, self.block_size):
+                    read_queue.put(block)
+            except Exception as e:  # handed to the processing stage, which would otherwise wait forever
+                read_queue.put(e)
+                return
+            read_queue.put(None)
+
+        threading.Thread(target=reader, daemon=True).start()
+        remainder = ""
+        while True:
+            block = read_queue.get()
+            if block is None: break
+            if isinstance(block, Exception): raise block
+            lines = (remainder + block).split("\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if remainder != "":
+            yield remainder
+
+    def close(self):
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        if self.writer_error is not None:
+            raise self.writer_error
+
+class ShardReader:
+    """Text reader over the i-th of N byte ranges of a file.
+    A \\n terminated line belongs to the shard its first byte falls in, so N shards together cover every line exactly once.
+    Within it \\r\\n and lone \\r end lines as well, the same as the universal newlines of an unsharded text mode read."""
+    def __init__(self, input_file, shard):
+        shard_index, shard_count = [int(x) for x in shard.split("/")]
+        file_size = os.path.getsize(input_file)
+        self.file_handler = open(input_file, "rb")
+        self.position = file_size * shard_index // shard_count
+        self.end = file_size * (shard_index + 1) // shard_count
+        if self.position > 0:
+            # Skip the line that started in the previous shard
+            self.file_handler.seek(self.position - 1)
+            self.position += len(self.file_handler.readline()) - 1
+
+    def __iter__(self):
+        while self.position < self.end:
+            line = self.file_handler.readline()
+            if not line: return
+            self.position += len(line)
+            lines = line.decode("utf-8", errors="ignore").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            for part in lines[:-1]:
+                yield part + "\n"
+            if lines[-1] != "":
+                yield lines[-1]
+
+    def read(self, size=-1):
+        lines = []
+        length = 0
+        for line in self:
+            lines.append(line)
+            length += len(line)
+            if size >= 0 and length >= size: break
+        return "".join(lines)
+
+    def close(self):
+        self.file_handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def next_prime(number):
+    number |= 1
+    while any(number % divisor == 0 for divisor in range(3, int(number ** 0.5) + 1, 2)):
+        number += 2
+    return number
+
+class GramBucket:
+    """All grams of one encoded length, stored back to back in a bytearray so no length prefix or offset is needed.
+    The open-addressing table holds entry numbers plus one (0 marks a free slot) and counts is indexed by entry number.
+    Counts start as array('B') and widen to 'H', 'I' and then 'Q' only once a count no longer fits.
+    The table has a prime size and grows by half once 85% full, so it never drops below 56% full."""
+    sort_chunk = 65536
+
+    def __init__(self, length):
+        self.length = length
+        self.arena = bytearray()
+        self.counts = array('B')
+        self.table = array('I', bytes(4 * 11))
+
+    def find(self, key):
+        # Returns (slot, entry) where entry is -1 when the key is not stored and slot is where it would go.
+        # Double hashing visits every slot of the prime sized table and keeps probe chains short at high load,
+        # startswith compares in place without slicing the arena.
+        length = self.length
+        arena = self.arena
+        table = self.table
+        size = len(table)
+        key_hash = hash(key)
+        slot = key_hash % size
+        step = 1 + (key_hash >> 17) % (size - 1)
+        while True:
+            entry = table[slot] - 1
+            if entry < 0 or arena.startswith(key, entry * length):
+                return slot, entry
+            slot = (slot + step) % size
+
+    def widen(self):
+        self.counts = array({'B': 'H', 'H': 'I'}.get(self.counts.typecode, 'Q'), self.counts)
+
+    def add(self, key, count):
+        slot, entry = self.find(key)
+        if entry >= 0:
+            while True:
+                try:
+                    self.counts[entry] += count
+                    return False
+                except OverflowError:
+                    self.widen()
+        self.insert(slot, key, count)
+        return True
+
+    def insert(self, slot, key, count):
+        while True:
+            try:
+                self.counts.append(count)
+                break
+            except OverflowError:
+                self.widen()
+        self.arena += key
+        self.table[slot] = len(self.counts)
+        if len(self.counts) * 20 >= len(self.table) * 17:  # keep the table at most 85% full
+            self.grow()
+
+    def grow(self):
+        length = self.length
+        size = next_prime(len(self.table) * 3 // 2)
+        table = self.table = array('I', bytes(4 * size))
+        # Rehash from bytes copies of about 1MB of the arena at a time instead of copying every key twice
+        chunk_entries = max(1, 1048576 // max(1, length))
+        for chunk_start in range(0, len(self.counts), chunk_entries):
+            chunk_end = min(chunk_start + chunk_entries, len(self.counts))
+            chunk = bytes(self.arena[chunk_start*length:chunk_end*length])
+            keys = [chunk[offset:offset+length] for offset in range(0, len(chunk), length)]
+            for entry, key_hash in enumerate(map(hash, keys), chunk_start + 1):
+                slot = key_hash % size
+                if table[slot]:
+                    step = 1 + (key_hash >> 17) % (size - 1)
+                    while table[slot]:
+                        slot = (slot + step) % size
+                table[slot] = entry
+
+    def key(self, entry):
+        return self.arena[entry*self.length:(entry+1)*self.length].decode("utf-8", errors="surrogatepass")
+
+    def items_by_gram(self):
+        for entry in self.sorted_entries(range(len(self.counts)), 0):
+            yield self.key(entry), self.counts[entry]
+
+    def sorted_entries(self, entries, depth):
+        # Sorting all entries at once needs a bytes key object per entry, several times the size of the bucket.
+        # Entries are split on their byte at depth with a counting sort into an array('I') instead, and only
+        # groups of at most sort_chunk entries get keys, so sorting takes about 8 extra bytes per entry.
+        length = self.length
+        arena = self.arena
+        if len(entries) <= self.sort_chunk:
+            yield from sorted(entries, key=lambda entry: arena[entry*length+depth:(entry+1)*length])
+            return
+
+        column = bytes(arena[entry*length+depth] for entry in entries)
+        histogram = Counter(column)
+        position = {}
+        total = 0
+        for byte in sorted(histogram):
+            position[byte] = total
+            total += histogram[byte]
+        order = array('I', bytes(4 * len(entries)))
+        for entry, byte in zip(entries, column):
+            order[position[byte]] = entry
+            position[byte] += 1
+        del entries, column
+
+        start = 0
+        for byte in sorted(histogram):
+            yield from self.sorted_entries(order[start:start+histogram[byte]], depth + 1)
+            start += histogram[byte]
+
+    def items_by_count(self):
+        # Counting sort on the counts so the only extra memory is one array('I') of entry numbers
+        histogram = {}
+        for count in self.counts:
+            histogram[count] = histogram.get(count, 0) + 1
+        position = {}
+        total = 0
+        for count in sorted(histogram, reverse=True):
+            position[count] = total
+            total += histogram[count]
+        order = array('I', bytes(4 * len(self.counts)))
+        for entry, count in enumerate(self.counts):
+            order[position[count]] = entry
+            position[count] += 1
+        for entry in order:
+            yield self.key(entry), self.counts[entry]
+
+class GramStore:
+    """Compact gram counter used by --partial and reduce.
+    Grams are kept as UTF-8 bytes in one GramBucket per length instead of as str keys of a dict,
+    which takes a fifth to a seventh of the memory for grams of up to 8 bytes and a fourth to a fifth for the
+    longer grams of --rolling, but makes --rolling --partial about 2.5 times slower than counting in a dict."""
+    def __init__(self):
+        self.buckets = {}
+        self.size = 0
+
+    def update(self, items):
+        # Adds (gram, count) pairs. This is the hot loop of --partial, so GramBucket.find is inlined here.
+        buckets = self.buckets
+        for gram, count in items:
+            key = gram.encode("utf-8", errors="surrogatepass")
+            length = len(key)
+            bucket = buckets.get(length)
+            if bucket is None:
+                bucket = buckets[length] = GramBucket(length)
+            arena = bucket.arena
+            table = bucket.table
+            size = len(table)
+            key_hash = hash(key)
+            slot = key_hash % size
+            entry = table[slot] - 1
+            if entry >= 0 and not arena.startswith(key, entry * length):
+                step = 1 + (key_hash >> 17) % (size - 1)
+                while True:
+                    slot = (slot + step) % size
+                    entry = table[slot] - 1
+                    if entry < 0 or arena.startswith(key, entry * length):
+                        break
+
+            if entry < 0:
+                self.size += 1
+                counts = bucket.counts
+                try:
+                    counts.append(count)
+                except OverflowError:
+                    bucket.insert(slot, key, count)  # widens the counts as far as needed
+                    continue
+                arena += key
+                table[slot] = len(counts)
+                if len(counts) * 20 >= len(table) * 17:  # keep the table at most 85% full
+                    bucket.grow()
+                continue
+            try:
+                bucket.counts[entry] += count
+            except OverflowError:
+                bucket.add(key, count)  # widens the counts as far as needed
+
+    def get(self, gram):
+        key = gram.encode("utf-8", errors="surrogatepass")
+        bucket = self.buckets.get(len(key))
+        if bucket is None:
+            return 0
+        slot, entry = bucket.find(key)
+        return bucket.counts[entry] if entry >= 0 else 0
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return sum(len(bucket.arena) + len(bucket.counts) * bucket.counts.itemsize + len(bucket.table) * bucket.table.itemsize
+                   for bucket in self.buckets.values())
+
+    def items_by_gram(self):
+        # UTF-8 byte order matches str order, so merging the sorted buckets gives the partial file order
+        return heapq.merge(*[bucket.items_by_gram() for length, bucket in sorted(self.buckets.items())])
+
+    def items_by_count(self):
+        return heapq.merge(*[bucket.items_by_count() for length, bucket in sorted(self.buckets.items())],
+                           key=lambda item: -item[1])
+
+    def spill(self, file_name, by_count=False):
+        write_partial(file_name, self.items_by_count() if by_count else self.items_by_gram())
+        self.buckets = {}
+        self.size = 0
+
+class PartialCountWriter:
+    """Counts the lines written to an output and stores them as a sorted partial count file on close.
+    Repeated grams are first summed in a small dict batch so the GramStore sees each of them once per batch.
+    Counts are spilled to sorted run files whenever the GramStore outgrows GRAM_STORE_SPILL_BYTES."""
+    batch_size = 65536
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.store = GramStore()
+        self.batch = {}
+        self.pending = ""
+        self.spill_files = []
+
+    def write(self, data):
+        batch = self.batch
+        newline = data.find("\n")
+        if newline == len(data) - 1 and self.pending == "":
+            # Most writers hand over exactly one line at a time
+            gram = data[:-1]
+            batch[gram] = batch.get(gram, 0) + 1
+        elif newline < 0:
+            self.pending += data
+            return
+        else:
+            lines = (self.pending + data).split("\n")
+            self.pending = lines.pop()
+            for line in lines:
+                batch[line] = batch.get(line, 0) + 1
+        if len(batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.store.update(self.batch.items())
+        self.batch = {}
+        if self.store.nbytes() > GRAM_STORE_SPILL_BYTES:
+            self.spill_files.append(self.file_name + ".spill" + str(len(self.spill_files)))
+            self.store.spill(self.spill_files[-1])
+
+    def close(self):
+        if self.pending != "":
+            self.write("\n")
+        self.flush()
+        if len(self.spill_files) == 0:
+            self.store.spill(self.file_name)
+            return
+
+        self.spill_files.append(self.file_name + ".spill" + str(len(self.spill_files)))
+        self.store.spill(self.spill_files[-1])
+        write_partial(self.file_name, merge_partials(self.spill_files))
+        for spill_file in self.spill_files:
+            os.remove(spill_file)
+
+def write_partial(file_name, items):
+    # Partial count files hold "<count>\t<gram>" lines sorted by gram so any number of them can be merged as streams
+    with open(file_name, "w", encoding="utf-8", errors="ignore") as partial_file_handler:
+        for gram, count in items:
+            partial_file_handler.write(str(count) + "\t" + gram + "\n")
+
+def read_partial(file_name):
+    with open(file_name, "r", encoding="utf-8", errors="ignore", newline="\n") as partial_file_handler:
+        for line in partial_file_handler:
+            count, gram = line[:-1].split("\t", 1)
+            yield gram, int(count)
+
+def merge_partials(partial_files):
+    # Yields every gram of the partial files once with its summed count, in gram order
+    last_gram = None
+    total = 0
+    for gram, count in heapq.merge(*[read_partial(partial_file) for partial_file in partial_files]):
+        if gram == last_gram:
+            total += count
+            continue
+        if last_gram is not None:
+            yield last_gram, total
+        last_gram = gram
+        total = count
+    if last_gram is not None:
+        yield last_gram, total
+
+def partial_suffix(docopt_args):
+    if not docopt_args.get('--partial'):
+        return None
+    shard = docopt_args.get('--shard') or "0/1"
+    return ".part" + shard.replace("/", "of")
+
+def open_input(input_file, shard):
+    if shard is not None:
+        return ShardReader(input_file, shard)
+    return open(input_file, "r", encoding="utf-8", errors="ignore")
+
+def open_output(file_name, pipeline, suffix=None):
+    if suffix is not None:
+        return PartialCountWriter(file_name + suffix)
+    if pipeline is not None:
+        return pipeline.open(file_name)
+    return open(file_name, "a+", encoding="utf-8", errors="ignore")
+
+def read_lines(file_handler, pipeline):
+    if pipeline is not None:
+        return pipeline.read_lines(file_handler)
+    return file_handler
+
+class LineLengthPolicy:
+    """Routes input lines longer than --max-line-length according to --long-line and counts every route taken"""
+    long_line_options = ["skip", "truncate", "window", "separate-file"]
+
+    def __init__(self, docopt_args, long_line_file, pipeline, default_max_line_length=None, window_overlap=0):
+        if docopt_args.get('--max-line-length') is None:
+            self.max_line_length = default_max_line_length
+        else:
+            self.max_line_length = int(docopt_args.get('--max-line-length'))
+
+        if docopt_args.get('--long-line') is None:
+            self.long_line = "skip"
+        else:
+            self.long_line = docopt_args.get('--long-line')
+
+        if docopt_args.get('--shard') is not None:
+            long_line_file += ".shard" + docopt_args.get('--shard').replace("/", "of")
+        self.long_line_file = long_line_file
+        self.long_line_file_handler = None
+        # run_workers prints one report summed over its shards instead
+        self.worker_shard = docopt_args.get('--shard') is not None and docopt_args.get('--workers') is not None
+        self.pipeline = pipeline
+        self.counts = {"processed": 0, "skip": 0, "truncate": 0, "window": 0, "separate-file": 0}
+        # Windows overlap by the longest gram minus one character so no gram is cut at a window boundary.
+        # window_owned is how many leading characters of the current window no later window starts at,
+        # None for whole lines and last windows, which lets --rolling emit every gram exactly once.
+        self.window_overlap = max(0, window_overlap)
+        self.window_owned = None
+
+    def lines(self, lines):
+        for line in lines:
+            plaintext = line.rstrip("\r\n")
+            if self.max_line_length is None or len(plaintext) <= self.max_line_length:
+                self.counts["processed"] += 1
+                yield line
+                continue
+
+            self.counts[self.long_line] += 1
+            if self.long_line == "truncate":
+                yield plaintext[:self.max_line_length] + "\n"
+            elif self.long_line == "window":
+                step = max(1, self.max_line_length - self.window_overlap)
+                for i in range(0, len(plaintext), step):
+                    last = i + self.max_line_length >= len(plaintext)
+                    self.window_owned = None if last else step
+                    yield plaintext[i:i+self.max_line_length] + "\n"
+                    if last:
+                        break
+            elif self.long_line == "separate-file":
+                if self.long_line_file_handler is None:
+                    self.long_line_file_handler = open_output(self.long_line_file, self.pipeline)
+                self.long_line_file_handler.write(plaintext + "\n")
+
+    def close(self, report_file=sys.stdout):
+        if self.long_line_file_handler is not None:
+            self.long_line_file_handler.close()
+        if self.max_line_length is None:
+            return
+
+        line_length_reports.append((self.max_line_length, self.long_line_file, self.counts))
+        if not self.worker_shard:
+            print_line_length_report(self.max_line_length, self.long_line_file, self.counts, report_file)
+
+def print_line_length_report(max_line_length, long_line_file, counts, report_file=sys.stdout):
+    print("Lines processed: " + str(counts["processed"]), file=report_file)
+    print("Lines over " + str(max_line_length) + " characters: " +
+          str(counts["skip"]) + " skipped, " +
+          str(counts["truncate"]) + " truncated, " +
+          str(counts["window"]) + " windowed, " +
+          str(counts["separate-file"]) + " written to " + long_line_file, file=report_file)
+
+def mask_structure(line_mask):
+    # Collapse the per-character mask into its charset segments: ?u?l?l?d?d -> upper-lower-numeric
+    names = {"?l": "lower", "?u": "upper", "?d": "numeric", "?s": "special", "?b": "unknown"}
+    structure = []
+    for item in line_mask:
+        if len(structure) == 0 or structure[-1] != names[item]:
+            structure.append(names[item])
+    return "-".join(structure)
+
+def write_statistics(output_name, line_total, length_counter, structure_counter, mask_counter, suffix=None):
+    mask_file = output_name + ".hcmask"
+    stats_file = output_name + ".stats"
+    if suffix is not None:
+        # Shards write all three counters into one partial as "<section>\t<item>" grams, reduce writes the real files
+        stats_partial = STATS_PARTIAL_PREFIX + output_name
+        print("Writing statistics output to: " + stats_partial + suffix)
+        items = []
+        for section, counter in [("length", length_counter), ("structure", structure_counter), ("mask", mask_counter)]:
+            items += [(section + "\t" + str(item), count) for item, count in counter.items()]
+        write_partial(stats_partial + suffix, sorted(items))
+        output_file_names.append(stats_partial)
+        return
+
+    print("Writing mask output to: " + mask_file)
+    print("Writing statistics output to: " + stats_file)
+
+    with open(mask_file, "w", encoding="utf-8") as mask_file_handler:
+        for mask in sorted(mask_counter, key=mask_counter.get, reverse=True):
+            mask_file_handler.write(mask + "\n")
+
+    with open(stats_file, "w", encoding="utf-8") as stats_file_handler:
+        stats_file_handler.write("[*] Analyzed " + str(line_total) + " passwords\n")
+        for title, counter in [("Length", length_counter), ("Structure", structure_counter), ("Masks", mask_counter)]:
+            stats_file_handler.write("\n[*] " + title + ":\n")
+            for item, count in counter.most_common():
+                percentage = count * 100 // line_total if line_total else 0
+                stats_file_handler.write("[+] " + str(item).rjust(25) + ": " + (str(percentage) + "%").rjust(4) + " (" + str(count) + ")\n")
+
 def cgramify(docopt_args):
     input_file = docopt_args['<input_file>']
     output_file = docopt_args['<output_file>']
@@ -516,30 +1110,35 @@ def cgramify(docopt_args):
     special =      set(['!', '"', '#', '$', '%', '&', '(', ')', '*', '+', ',', '.', '/', ';', '<', '>', '?', '@', '[', '\\', ']', '^', '_', '`', '{', '|', '}', '~', '+', ' '])
     special_full = set(['!', '"', '#', '$', '%', '&', '(', ')', '*', '+', ',', '.', '/', ';', '<', '>', '?', '@', '[', '\\', ']', '^', '_', '`', '{', '|', '}', '~', '+', ' ', '\'', '-'])
     cgram_rulify = False
+    collect_stats = bool(docopt_args.get('--stats'))
+    line_total = 0
+    length_counter = Counter()
+    structure_counter = Counter()
+    mask_counter = Counter()
     # does not include ' and - because of their common use in normal language
 
-    if ARGS.get('--min-length') is None:
+    if docopt_args.get('--min-length') is None:
         min_length = 3
     else:
         min_length = int(docopt_args.get('--min-length'))
 
-    if ARGS.get('--cgram-rulify-beta'):
+    if docopt_args.get('--cgram-rulify-beta'):
         cgram_rulify = True
 
-    if ARGS.get('--max-length') is None:
+    if docopt_args.get('--max-length') is None:
         max_length = 32
     else:
         max_length = int(docopt_args.get('--max-length'))
 
-    if ARGS.get('--filter') is None:
+    if docopt_args.get('--filter') is None:
         output_filter = []
     else:
-        if ARGS.get('--filter') is not None:
+        if docopt_args.get('--filter') is not None:
             output_filter = docopt_args.get('--filter')
             output_filter = output_filter.split(",")
             if "" in output_filter: output_filter.remove("")
 
-    if ARGS.get('--filter-combo-length-beta') is not None:
+    if docopt_args.get('--filter-combo-length-beta') is not None:
         output_filter_count = int(docopt_args.get('--filter-combo-length'))
         all_combinations = []
         for i in range(1, output_filter_count+1):
@@ -557,58 +1156,50 @@ def cgramify(docopt_args):
                 combinations_output.remove(item)
         output_filter += combinations_output
 
-        for item in output_filter:  # using this more complex filter to allow for more complex filters in the future such as startmidstartend
-            original_item = item
-            if item in ["solo", "duo", "duostart", "duoend"]: continue
-            while(len(item) > 0):
-                match = False
-                if item.startswith("start"):
-                    match = True
-                    item = item[len("start"):]
-                if item.startswith("mid"):
-                    if(min_length != 1):
-                        print("Warning: You are using a filter with 'mid'. It is highly advised to set --min-length to 1 for this.")
-                    match =  True
-                    item = item[len("mid"):]
-                if item.startswith("end"):
-                    match =  True
-                    item = item[len("end"):]
-                if not match:
-                    break
-            if(len(item) > 0):
-                print("--filter value \"" + original_item + "\" is not a valid filter and must consist exclusively of solo, duo, duostart, duoend, start, mid, and end - or any combination of 'start, mid, or end'. (ex: startmidmidend)")
-                sys.exit()
-
-    print("Counting lines")
-    with open(input_file, "r",encoding="utf-8",errors='ignore') as f:
-        line_count = sum(bl.count("\n") for bl in blocks(f))
-    
-    input_file_handler = open(input_file, "r", encoding="utf-8", errors="ignore")
-    output_file_handler = open("c_" + output_file, "a+", encoding="utf-8", errors="ignore")
+        if min_length != 1 and any("mid" in item for item in output_filter if item not in ["solo", "duo", "duostart", "duoend"]):
+            print("Warning: You are using a filter with 'mid'. It is highly advised to set --min-length to 1 for this.")
+
+    # Only draw a progress bar on a terminal, this skips importing tqdm and counting lines for scripted runs
+    show_progress = sys.stderr.isatty()
+    if show_progress:
+        print("Counting lines")
+        with open_input(input_file, docopt_args.get('--shard')) as f:
+            line_count = sum(bl.count("\n") for bl in blocks(f))
+
+    pipeline = IOPipeline() if docopt_args.get('--pipeline') else None
+    suffix = partial_suffix(docopt_args)
+    input_file_handler = open_input(input_file, docopt_args.get('--shard'))
+    output_file_handler = open_output("c_" + output_file, pipeline, suffix)
     print("Writing output to: c_" + output_file)
     output_file_names.append("c_" + output_file)
 
     output_filter_file_handler = {}
     for item in output_filter:
-        output_filter_file_handler[item] = open("c_" + item + "_" + output_file, "a+", encoding="utf-8", errors="ignore")
+        output_filter_file_handler[item] = open_output("c_" + item + "_" + output_file, pipeline, suffix)
         print("Writing filter output to: c_" + item + "_" + output_file)
         output_file_names.append("c_" + item + "_" + output_file)
 
     output_rule_file_handler = {}
     if cgram_rulify:
         for item in output_filter:
-            output_rule_file_handler[item] = open("c_" + item + "_" + output_file + ".rule", "a+", encoding="utf-8", errors="ignore")
+            output_rule_file_handler[item] = open_output("c_" + item + "_" + output_file + ".rule", pipeline, suffix)
             print("Writing rule output to: c_" + item + "_" + output_file + ".rule")
             output_file_names.append("c_" + item + "_" + output_file + ".rule")
 
     ########################
     ### Start processing ###
     ########################
-    for line in tqdm(input_file_handler, bar_format='{l_bar}{bar:50}{r_bar}{bar:-50b}', total=line_count, miniters=10000):
+    line_policy = LineLengthPolicy(docopt_args, "long_" + output_file, pipeline, window_overlap=max_length - 1)
+    lines = line_policy.lines(read_lines(input_file_handler, pipeline))
+    if show_progress:
+        from tqdm import tqdm
+        lines = tqdm(lines, bar_format='{l_bar}{bar:50}{r_bar}{bar:-50b}', total=line_count, miniters=10000)
+    for line in lines:
         original_plaintext = line.rstrip("\r\n")
 
         # Handle $HEX[] notation
         if line.startswith("$HEX["):
+            import binascii
             try:
                 line = binascii.unhexlify(line[5:-1])
             except binascii.Error:
@@ -618,6 +1209,7 @@ def cgramify(docopt_args):
         character_buffer = []
         matches = []
         all_matches = []
+        line_mask = []
         for char in original_plaintext:
             is_lowercase = True if char in lowercase else False
             if not is_lowercase:
@@ -636,6 +1228,18 @@ def cgramify(docopt_args):
             else:
                 current_charset = 'unknown'
 
+            if collect_stats:
+                if is_lowercase:
+                    line_mask.append("?l")
+                elif is_uppercase:
+                    line_mask.append("?u")
+                elif current_charset == 'numeric':
+                    line_mask.append("?d")
+                elif current_charset == 'special' or ' ' <= char <= '~':  # ASCII punctuation outside special_full
+                    line_mask.append("?s")
+                else:
+                    line_mask += ["?b"] * len(char.encode("utf-8", errors="ignore"))
+
             if current_charset == last_charset or current_charset == 'unknown':  # treat unknown as every set
                 character_buffer.append(char)
                 continue
@@ -662,6 +1266,12 @@ def cgramify(docopt_args):
             output_file_handler.write("".join(character_buffer) + "\n")
             matches.append("".join(character_buffer))
 
+        if collect_stats and len(line_mask) > 0:
+            line_total += 1
+            length_counter[len(line_mask)] += 1  # in bytes like the ?b mask items, matching hashcat
+            structure_counter[mask_structure(line_mask)] += 1
+            mask_counter["".join(line_mask)] += 1
+
         # Output matches into filter outputs
         output_filter_writer(output_filter, output_filter_file_handler, matches)
         if cgram_rulify: output_rule_filter_writer(output_filter, output_rule_file_handler, matches)
@@ -670,7 +1280,7 @@ def cgramify(docopt_args):
         # get new matches by glueing together parts that have 1-length in between
         glue_parts(cgram_rulify, min_length, max_length, output_filter, output_file_handler, output_filter_file_handler, output_rule_file_handler, all_matches)
 
-        if ARGS.get('--mixed'):
+        if docopt_args.get('--mixed'):
             # Mixed case + less strict special check
             lowercased = False
             matches = []
@@ -756,39 +1366,264 @@ def cgramify(docopt_args):
     output_file_handler.close()
     for filter_item in output_filter:
         output_filter_file_handler[filter_item].close()
+    for filter_item in output_rule_file_handler:
+        output_rule_file_handler[filter_item].close()
+    line_policy.close()
+    if pipeline is not None: pipeline.close()
 
-if __name__ == '__main__':
-    ARGS = docopt(__doc__, version='2.5')
-    if not os.path.exists(ARGS.get('<input_file>')):
+    if collect_stats:
+        write_statistics("c_" + output_file, line_total, length_counter, structure_counter, mask_counter, suffix)
+
+def reduce_partials(docopt_args):
+    if docopt_args.get('--min-count') is None:
+        min_count = 1
+    else:
+        min_count = int(docopt_args.get('--min-count'))
+
+    # c_out.txt.part0of4 and c_out.txt.part3of4 both reduce into c_out.txt.sorted, stats_c_out.txt.part0of4 into c_out.txt.stats
+    partial_groups = {}
+    for partial_file in docopt_args['<partial_file>']:
+        output_name = re.sub(r"\.part\d+of\d+$", "", os.path.basename(partial_file))
+        partial_groups.setdefault(output_name, []).append(partial_file)
+
+    for output_name, partial_files in partial_groups.items():
+        if output_name.startswith(STATS_PARTIAL_PREFIX):
+            reduce_statistics(output_name[len(STATS_PARTIAL_PREFIX):], partial_files)
+            continue
+
+        # merge_partials yields every gram once, so the count sorted spill files never share a gram
+        store = GramStore()
+        spill_files = []
+        kept = ((gram, count) for gram, count in merge_partials(partial_files) if count >= min_count)
+        for items in iter(lambda: list(islice(kept, PartialCountWriter.batch_size)), []):
+            store.update(items)
+            if store.nbytes() > GRAM_STORE_SPILL_BYTES:
+                spill_files.append(output_name + ".sorted.spill" + str(len(spill_files)))
+                store.spill(spill_files[-1], by_count=True)
+
+        if len(spill_files) == 0:
+            items = store.items_by_count()
+        else:
+            spill_files.append(output_name + ".sorted.spill" + str(len(spill_files)))
+            store.spill(spill_files[-1], by_count=True)
+            items = heapq.merge(*[read_partial(spill_file) for spill_file in spill_files], key=lambda item: -item[1])
+
+        print("Writing reduced output to: " + output_name + ".sorted")
+        with open(output_name + ".sorted", "w", encoding="utf-8", errors="ignore") as output_file_handler:
+            for gram, count in items:
+                output_file_handler.write(gram + "\n")
+        for spill_file in spill_files:
+            os.remove(spill_file)
+
+def reduce_statistics(output_name, partial_files):
+    counters = {"length": Counter(), "structure": Counter(), "mask": Counter()}
+    for gram, count in merge_partials(partial_files):
+        section, item = gram.split("\t", 1)
+        counters[section][int(item) if section == "length" else item] += count
+
+    # Every analyzed password has exactly one mask
+    line_total = sum(counters["mask"].values())
+    write_statistics(output_name, line_total, counters["length"], counters["structure"], counters["mask"])
+
+def run_mode(docopt_args):
+    if docopt_args.get('word'):
+        ngramify(docopt_args)
+
+    if docopt_args.get('character'):
+        kgramify(docopt_args)
+
+    if docopt_args.get('charset'):
+        cgramify(docopt_args)
+
+def run_shard(docopt_args):
+    del output_file_names[:]
+    del line_length_reports[:]
+    run_mode(docopt_args)
+    suffix = partial_suffix(docopt_args)
+    return [item + suffix for item in output_file_names], list(line_length_reports)
+
+def run_workers(docopt_args):
+    workers = int(docopt_args.get('--workers'))
+    shard_args = []
+    for i in range(workers):
+        shard_arg = dict(docopt_args)
+        shard_arg['--shard'] = str(i) + "/" + str(workers)
+        shard_arg['--partial'] = True
+        shard_args.append(shard_arg)
+
+    import multiprocessing
+    with multiprocessing.Pool(workers) as pool:
+        shard_results = pool.map(run_shard, shard_args)
+    partial_files = [item for shard_files, shard_reports in shard_results for item in shard_files]
+
+    reduce_partials({'<partial_file>': partial_files, '--min-count': docopt_args.get('--min-count')})
+    for partial_file in partial_files:
+        os.remove(partial_file)
+
+    # Every shard runs the same mode, so the n-th line length report of each shard comes from the same policy
+    for reports in zip(*[shard_reports for shard_files, shard_reports in shard_results]):
+        counts = Counter()
+        for max_line_length, long_line_file, shard_counts in reports:
+            counts.update(shard_counts)
+        long_line_file = re.sub(r"\.shard\d+of\d+$", ".shard*of" + str(workers), reports[0][1])
+        print_line_length_report(reports[0][0], long_line_file, counts)
+
+def valid_filter_item(item):
+    # using this more complex filter to allow for more complex filters in the future such as startmidstartend
+    if item in ["solo", "duo", "duostart", "duoend"]:
+        return True
+    while len(item) > 0:
+        for element in ["start", "mid", "end"]:
+            if item.startswith(element):
+                item = item[len(element):]
+                break
+        else:
+            return False
+    return True
+
+def validate_args(docopt_args):
+    if docopt_args.get('batch'):
+        if not os.path.exists(docopt_args.get('<manifest_file>')):
+            print("Manifest file does not exist.")
+            return False
+    elif docopt_args.get('reduce'):
+        for partial_file in docopt_args.get('<partial_file>'):
+            if not os.path.exists(partial_file):
+                print("Partial file does not exist: " + partial_file)
+                return False
+    elif not os.path.exists(docopt_args.get('<input_file>')):
         print("Input file does not exist.")
-        sys.exit()
+        return False
 
-    if ARGS.get('--min-length') is not None and int(ARGS.get('--min-length')) < 0:
-        print("Min Length should be greater than 0.")
-        sys.exit()
+    # Every option that is passed to int() later is checked here, so a mode never fails halfway on its arguments
+    if docopt_args.get('--min-length') is not None and not docopt_args.get('--min-length').isdecimal():
+        print("Min Length should be a number of 0 or more.")
+        return False
 
-    if ARGS.get('--max-length') is not None and int(ARGS.get('--max-length', 1)) < 0:
-        print("Max Length should be greater than 0.")
-        sys.exit()
+    if docopt_args.get('--max-length') is not None and not docopt_args.get('--max-length').isdecimal():
+        print("Max Length should be a number of 0 or more.")
+        return False
 
-    if ARGS.get('--min-length') is not None and ARGS.get('--max-length') is not None:
-        if int(ARGS.get('--min-length')) > int(ARGS.get('--max-length')):
+    if docopt_args.get('--min-length') is not None and docopt_args.get('--max-length') is not None:
+        if int(docopt_args.get('--min-length')) > int(docopt_args.get('--max-length')):
             print("Min Length should be smaller or equal to Max length.")
-            exit()
+            return False
+
+    if docopt_args.get('--max-line-length') is not None:
+        if not docopt_args.get('--max-line-length').isdecimal() or int(docopt_args.get('--max-line-length')) < 1:
+            print("Max line length should be a number greater than 0.")
+            return False
+
+    if docopt_args.get('character') and docopt_args.get('--stdout') and not docopt_args.get('--rolling'):
+        print("Cannot use --stdout without --rolling")
+        return False
+
+    if docopt_args.get('--filter') is not None:
+        for item in docopt_args.get('--filter').split(","):
+            if item != "" and not valid_filter_item(item):
+                print("--filter value \"" + item + "\" is not a valid filter and must consist exclusively of solo, duo, duostart, duoend, start, mid, and end - or any combination of 'start, mid, or end'. (ex: startmidmidend)")
+                return False
+
+    if docopt_args.get('--long-line') is not None and docopt_args.get('--long-line') not in LineLengthPolicy.long_line_options:
+        print("--long-line should be one of: " + ", ".join(LineLengthPolicy.long_line_options))
+        return False
 
-    if ARGS.get('--filter-combo-length') is not None and not ARGS.get('--filter-combo-length').isnumeric():
+    if docopt_args.get('--filter-combo-length') is not None and not docopt_args.get('--filter-combo-length').isdecimal():
         print("Filter combo length should be numeric")
-        exit()
+        return False
+
+    if docopt_args.get('--shard') is not None:
+        shard = docopt_args.get('--shard').split("/")
+        if len(shard) != 2 or not shard[0].isdecimal() or not shard[1].isdecimal() or int(shard[0]) >= int(shard[1]):
+            print("Shard should be formatted as i/N with 0 <= i < N. (ex: --shard=0/4)")
+            return False
+
+    if docopt_args.get('--workers') is not None:
+        if not docopt_args.get('--workers').isdecimal() or int(docopt_args.get('--workers')) < 1:
+            print("Workers should be a number greater than 0.")
+            return False
+        if docopt_args.get('--shard') is not None or docopt_args.get('--partial') or docopt_args.get('--stdout'):
+            print("Cannot use --workers together with --shard, --partial or --stdout")
+            return False
+
+    if docopt_args.get('--partial') and docopt_args.get('--stdout'):
+        print("Cannot use --partial together with --stdout")
+        return False
+
+    if docopt_args.get('--min-count') is not None and not docopt_args.get('--min-count').isdecimal():
+        print("Min count should be numeric")
+        return False
+
+    if docopt_args.get('--min-count') is not None and not docopt_args.get('reduce') and docopt_args.get('--workers') is None:
+        print("--min-count only applies to reduce and --workers")
+        return False
+
+    return True
+
+def run_command(docopt_args):
+    if docopt_args.get('reduce'):
+        reduce_partials(docopt_args)
+    elif docopt_args.get('--workers') is not None:
+        run_workers(docopt_args)
+    else:
+        run_mode(docopt_args)
+
+def run_batch(docopt_args):
+    # Runs every command of the manifest in this process, saving the interpreter startup per input file
+    import shlex
+    manifest_args = []
+    with open(docopt_args['<manifest_file>'], encoding="utf-8") as manifest_file_handler:
+        for line_number, line in enumerate(manifest_file_handler, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                entry_args = docopt(__doc__, argv=shlex.split(line), version='2.5')
+            except (SystemExit, ValueError):
+                print("Invalid manifest entry on line " + str(line_number) + ": " + line)
+                return False
+            if entry_args.get('batch'):
+                print("Manifest entries cannot start another batch (line " + str(line_number) + ")")
+                return False
+            if not validate_args(entry_args):
+                print("Invalid manifest entry on line " + str(line_number) + ": " + line)
+                return False
+            manifest_args.append((line_number, entry_args))
+
+    # A failing entry, such as an unreadable input or a full disk, is reported and the remaining entries still run
+    failed = 0
+    for line_number, entry_args in manifest_args:
+        del output_file_names[:]
+        try:
+            run_command(entry_args)
+        except Exception as error:
+            print("Manifest entry on line " + str(line_number) + " failed: " + (str(error) or type(error).__name__))
+            failed += 1
+    print()
+    print("Processed " + str(len(manifest_args) - failed) + " manifest entries, " + str(failed) + " failed")
+    return failed == 0
+
+if __name__ == '__main__':
+    ARGS = docopt(__doc__, version='2.5')
+    if not validate_args(ARGS):
+        sys.exit()
 
-    if ARGS.get('word'):
-        ngramify(ARGS)
+    if ARGS.get('batch'):
+        if not run_batch(ARGS):
+            sys.exit(1)
+        sys.exit()
 
-    if ARGS.get('character'):
-        kgramify(ARGS)
+    run_command(ARGS)
+    if ARGS.get('reduce') or ARGS.get('--workers') is not None:
+        sys.exit()
 
-    if ARGS.get('charset'):
-        cgramify(ARGS)
     print()
+    if ARGS.get('--partial'):
+        shard_count = (ARGS.get('--shard') or "0/1").split("/")[1]
+        print("Merge the partial outputs of all shards with:")
+        print("gramify.py reduce " + " ".join(item + ".part*of" + shard_count for item in output_file_names))
+        sys.exit()
+
     print("Don't forget to de-duplicate and sort the output.\nRecommended commands:")
     for item in output_file_names:
         print("cat \"" + item + "\" | sort | uniq -c | sort -rn | awk '($1 >= 5)' | awk '{if ($1 >=1) {$1=\"\"; print substr($0, index($0, $2))}}' > \"" + item + ".sorted\"")